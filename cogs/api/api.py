@@ -5,6 +5,8 @@ from discord.ext import commands
 from config import LogType
 import config
 import aiohttp
+import functools
+from datetime import datetime, timedelta
 
 CONFIGS = config.get_cog_configs('api')
 STRINGS = config.get_cog_strings('api')
@@ -20,12 +22,30 @@ class OsuApi(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.token = None
-        self.token_expires_in = None
+        self.token_expires_at = None
         self.token_type = None
         self.__client = None
+        self.shared = None
 
     async def request_auth(self):
         """Attempts to request API authentication and authorization, and store token data.
+        With shared state connected, the token is shared with (and refreshed by) other bot processes.
+        """
+        if self.shared:
+            response = await self.shared.token(self.request_token)
+            self.token_expires_at = response['expires_at']
+        else:
+            response = await self.request_token()
+            self.token_expires_at = datetime.utcnow() + timedelta(seconds=response['expires_in'])
+        self.token = response['access_token']
+        self.token_type = response['token_type']
+
+        # Keep an already running client on the current token
+        if isinstance(self.__client, aiohttp.ClientSession):
+            self.__client.headers['Authorization'] = self.token_type + ' ' + self.token
+
+    async def request_token(self):
+        """Requests a new API token, returning the API's token response.
         """
         # Generate credentials and parameters for the API authorization request.
         credentials = config.get_api_credentials()
@@ -42,12 +62,10 @@ class OsuApi(commands.Cog):
             async with session.post(url, json=payload) as response:
                 response = await response.json()
 
-        # Check if response is valid, and store token data
+        # Check if response is valid, and return token data
         if len(response) is 3:  # if somebody has a better way to check auth please help
-            self.token = response['access_token']
-            self.token_expires_in = response['expires_in']
-            self.token_type = response['token_type']
             self.bot.log(STRINGS.Auth.success_log, LogType.STATUS)
+            return response
         else:
             try:
                 error = response['error']
@@ -57,14 +75,21 @@ class OsuApi(commands.Cog):
             self.bot.log(error, LogType.ERROR)
             raise RuntimeWarning
 
-    async def client(self):
-        headers = HEADERS
+    def connect_shared(self):
+        """Shares the API token, rate limit and response cache with other bot processes
+        through the Database cog's MongoDB connection. Requires the Database cog to be loaded.
+        """
+        from .shared import SharedState  # pymongo is only required when sharing state
 
-        # Assign auth token to headers; request auth if nonexistent
+        self.bot.log(STRINGS.Shared.start_log, LogType.WARN)
+        self.shared = SharedState(self.bot)
+        self.bot.log(STRINGS.Shared.success_log, LogType.STATUS)
+
+    async def client(self):
+        # Request auth if no token exists yet
         if not self.token:
             try:
                 await self.request_auth()
-                headers['Authorization'] = self.token_type + ' ' + self.token
             except Exception:
                 self.bot.log(STRINGS.Client.fail_log, LogType.WARN)
                 raise
@@ -72,6 +97,7 @@ class OsuApi(commands.Cog):
         # Create a new client if .__client doesn't exist already
         if not isinstance(self.__client, aiohttp.ClientSession):
             self.bot.log(STRINGS.Client.create_log, LogType.WARN)
+            headers = dict(HEADERS, Authorization=self.token_type + ' ' + self.token)
             self.__client = aiohttp.ClientSession(headers=headers)
             self.bot.log(STRINGS.Client.success_log, LogType.STATUS)
 
@@ -82,9 +108,26 @@ class OsuApi(commands.Cog):
             session = client
         else:
             session = await self.client()
+
+        if not self.shared:
+            data, _ = await self.request(session, url, params)
+            return data
+
+        # Pick up the shared token again once it nears expiry
+        margin = timedelta(seconds=CONFIGS.shared.token_margin)
+        if self.token and self.token_expires_at - margin < datetime.utcnow():
+            await self.request_auth()
+        return await self.shared.fetch(url, params,
+                                       functools.partial(self.request, session, url, params))
+
+    async def request(self, session, url, params=None):
+        """Sends a GET request, returning the response data and whether it succeeded.
+        """
+        if self.shared:
+            await self.shared.acquire()
         async with session.get(url, params=params) as response:
             self.bot.log(STRINGS.Fetch.start_log.format(url=url))
-            return await response.json()
+            return await response.json(), response.status == 200
 
     @commands.command()
     async def auth_api(self, ctx):
@@ -97,4 +140,7 @@ class OsuApi(commands.Cog):
 
 
 def setup(bot):
-    bot.add_cog(OsuApi(bot))
+    cog = OsuApi(bot)
+    if CONFIGS.shared.enabled:
+        cog.connect_shared()
+    bot.add_cog(cog)
@@ -0,0 +1,286 @@
+"""Shared API State
+
+Cross-process coordination for OsuApi, backed by the MongoDB database the
+Database cog connects to. Lets several bot processes share a single API token,
+one rate limit budget and one response cache instead of each process keeping
+(and spending) its own.
+
+State lives in two collections; expired entries are swept by a TTL index on ``expires_at``:
+    <prefix>_state
+        'token'             the shared API token
+        'token_lock'        refresh lease held by whichever process is renewing the token
+        'pending:<key>'     fetch lease held by whichever process is fetching an uncached response
+        'bucket'            the shared rate limit token bucket
+    <prefix>_cache
+        cached API responses, keyed by url and parameters
+
+Database calls run in the event loop's default executor so they never block the bot.
+If the database becomes unreachable, every operation logs the error and falls back
+to local behaviour: a locally requested token, no caching and a conservative local
+rate limit.
+"""
+import asyncio
+import contextlib
+import functools
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from pymongo import errors
+
+import config
+from config import LogType
+
+CONFIGS = config.get_cog_configs('api').shared
+STRINGS = config.get_cog_strings('api').Shared
+
+
+class SharedState:
+    def __init__(self, bot):
+        self.bot = bot
+        db = bot.db().db
+        self.state = db[CONFIGS.collection_prefix + '_state']
+        self.cache = db[CONFIGS.collection_prefix + '_cache']
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._granted = 0  # leased requests not yet handed to a caller
+        self._waiting = 0  # callers currently inside acquire()
+        self._leasing = asyncio.Lock()
+        self._local = None  # fallback bucket while the database is unreachable
+
+        # TTL indexes let MongoDB expire stale tokens, locks and responses
+        self.state.create_index('expires_at', expireAfterSeconds=0)
+        self.cache.create_index('expires_at', expireAfterSeconds=0)
+
+    async def token(self, refresh):
+        """Returns the shared API token, refreshing it if it is missing or about to expire.
+        Only the process holding the refresh lock calls ``refresh``; the others wait
+        for it to publish the new token.
+        :parameter
+        refresh=:class:`coroutine function`
+            Requests a new token from the API, returning the API's token response.
+        :returns:class:`dict`
+            Token data with `access_token`, `token_type`, `expires_in` and `expires_at` keys.
+        """
+        try:
+            while True:
+                token = await self._find_token()
+                if token:
+                    return token
+
+                owner = await self._lock('token_lock', CONFIGS.lock_timeout)
+                if owner:
+                    break
+                await asyncio.sleep(CONFIGS.poll_interval)
+        except errors.PyMongoError as error:
+            self.bot.log(STRINGS.error_log.format(error=error), LogType.ERROR)
+            return _token(await refresh())
+
+        async with self._holding('token_lock', owner, CONFIGS.lock_timeout):
+            try:
+                # Another process may have published a token between the check and the lock
+                token = await self._find_token()
+                if token:
+                    return token
+            except errors.PyMongoError as error:
+                self.bot.log(STRINGS.error_log.format(error=error), LogType.ERROR)
+
+            token = _token(await refresh())
+            try:
+                await self._run(self.state.replace_one, {'_id': 'token'}, token, upsert=True)
+            except errors.PyMongoError as error:
+                self.bot.log(STRINGS.error_log.format(error=error), LogType.ERROR)
+            return token
+
+    async def _find_token(self):
+        margin = timedelta(seconds=CONFIGS.token_margin)
+        return await self._run(self.state.find_one,
+                               {'_id': 'token', 'expires_at': {'$gt': datetime.utcnow() + margin}})
+
+    async def _lock(self, name, timeout):
+        """Attempts to take the lock ``name`` for ``timeout`` seconds.
+        Returns an owner id to pass to _unlock() if taken, otherwise None.
+        """
+        now = datetime.utcnow()
+        owner = f"{self.owner}:{uuid.uuid4().hex}"
+        try:
+            # Only matches a missing or expired lock; a held lock makes the upsert collide on _id
+            await self._run(self.state.find_one_and_update,
+                            {'_id': name, 'expires_at': {'$lt': now}},
+                            {'$set': {'owner': owner,
+                                      'expires_at': now + timedelta(seconds=timeout)}},
+                            upsert=True)
+        except errors.DuplicateKeyError:
+            return None
+        return owner
+
+    async def _unlock(self, name, owner):
+        try:
+            await self._run(self.state.delete_one, {'_id': name, 'owner': owner})
+        except errors.PyMongoError as error:
+            # The lock's own expiry releases it eventually
+            self.bot.log(STRINGS.error_log.format(error=error), LogType.ERROR)
+
+    @contextlib.asynccontextmanager
+    async def _holding(self, name, owner, timeout):
+        """Keeps a taken lock alive, however long its holder waits, and releases it on exit.
+        A holder that dies stops renewing, so its lock still expires after ``timeout`` seconds.
+        """
+        renewal = asyncio.ensure_future(self._renew(name, owner, timeout))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await self._unlock(name, owner)
+
+    async def _renew(self, name, owner, timeout):
+        while True:
+            await asyncio.sleep(timeout / 2)
+            try:
+                await self._run(self.state.update_one, {'_id': name, 'owner': owner},
+                                {'$set': {'expires_at': datetime.utcnow() + timedelta(seconds=timeout)}})
+            except errors.PyMongoError as error:
+                self.bot.log(STRINGS.error_log.format(error=error), LogType.ERROR)
+
+    async def acquire(self):
+        """Waits until a request fits within the rate limit shared by all processes.
+        The limit is a token bucket holding up to `burst` requests and refilling at
+        `rate_limit - burst` requests per `rate_window`, so no `rate_window` ever sees
+        more than `rate_limit` requests across all processes. Requests are leased from
+        the bucket for every caller waiting at once, up to `lease_size` per database call.
+        """
+        self._waiting += 1
+        try:
+            async with self._leasing:
+                while not self._granted:
+                    # Shielded so that a cancelled caller's lease is kept for the next one
+                    wait = await asyncio.shield(self._lease(min(self._waiting, CONFIGS.lease_size)))
+                    if not self._granted:
+                        await asyncio.sleep(wait)
+                self._granted -= 1
+        finally:
+            self._waiting -= 1
+
+    async def _lease(self, size):
+        """Leases up to ``size`` requests into the granted pool.
+        Returns the seconds until the bucket next holds a request.
+        """
+        try:
+            granted, wait = await self._take(size)
+        except errors.PyMongoError as error:
+            self.bot.log(STRINGS.error_log.format(error=error), LogType.ERROR)
+            granted, wait = self._take_local(size)
+        self._granted += granted
+        return wait
+
+    async def _take(self, size):
+        """Takes up to ``size`` requests from the shared bucket, returning how many were
+        taken and the seconds until the bucket next holds a request.
+        """
+        rate = (CONFIGS.rate_limit - CONFIGS.burst) / CONFIGS.rate_window
+        while True:
+            now = time.time()
+            bucket = await self._run(self.state.find_one, {'_id': 'bucket'})
+            if bucket is None:
+                try:
+                    await self._run(self.state.insert_one,
+                                    {'_id': 'bucket', 'level': float(CONFIGS.burst), 'updated': now})
+                except errors.DuplicateKeyError:
+                    pass
+                continue
+
+            level, granted, wait = _drain(bucket['level'], bucket['updated'], now,
+                                          CONFIGS.burst, rate, size)
+            if not granted:
+                return 0, wait
+            # Only applies if no other process changed the bucket since it was read
+            result = await self._run(self.state.update_one,
+                                     {'_id': 'bucket', 'level': bucket['level'],
+                                      'updated': bucket['updated']},
+                                     {'$set': {'level': level, 'updated': max(now, bucket['updated'])}})
+            if result.modified_count:
+                return granted, wait
+
+    def _take_local(self, size):
+        """Takes up to ``size`` requests from this process' own fallback bucket of one
+        request, refilling at `fallback_rate_limit` requests per `rate_window`.
+        """
+        now = time.time()
+        rate = CONFIGS.fallback_rate_limit / CONFIGS.rate_window
+        level, updated = self._local or (1.0, now)
+        level, granted, wait = _drain(level, updated, now, 1, rate, size)
+        self._local = (level, max(now, updated))
+        return granted, wait
+
+    async def fetch(self, url, params, request):
+        """Returns the cached response for url and params, or fetches and caches it.
+        Only one process fetches a given uncached response at a time; the others wait
+        for it to appear in the cache, taking over if the fetching process stops renewing
+        its lock for `pending_timeout` seconds.
+        :parameter
+        request=:class:`coroutine function`
+            Fetches the response, returning the response data and whether it may be cached.
+        """
+        key = _cache_key(url, params)
+        try:
+            while True:
+                entry = await self._run(self.cache.find_one,
+                                        {'_id': key, 'expires_at': {'$gt': datetime.utcnow()}})
+                if entry:
+                    self.bot.log(STRINGS.cache_log.format(url=url))
+                    return entry['value']
+
+                owner = await self._lock('pending:' + key, CONFIGS.pending_timeout)
+                if owner:
+                    break
+                await asyncio.sleep(CONFIGS.poll_interval)
+        except errors.PyMongoError as error:
+            self.bot.log(STRINGS.error_log.format(error=error), LogType.ERROR)
+            data, _ = await request()
+            return data
+
+        async with self._holding('pending:' + key, owner, CONFIGS.pending_timeout):
+            data, cacheable = await request()
+            if cacheable:
+                expires_at = datetime.utcnow() + timedelta(seconds=CONFIGS.cache_ttl)
+                try:
+                    await self._run(self.cache.replace_one, {'_id': key},
+                                    {'value': data, 'expires_at': expires_at},
+                                    upsert=True)
+                except errors.PyMongoError as error:
+                    self.bot.log(STRINGS.error_log.format(error=error), LogType.ERROR)
+            return data
+
+    @staticmethod
+    async def _run(func, *args, **kwargs):
+        """Runs a blocking pymongo call in the default executor.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def _drain(level, updated, now, capacity, rate, size):
+    """Refills a token bucket up to ``now`` and takes up to ``size`` requests from it.
+    Returns the new level, the requests taken and the seconds until it next holds a request.
+    """
+    level = min(capacity, level + max(0.0, now - updated) * rate)
+    granted = min(size, int(level))
+    level -= granted
+    return level, granted, max(0.0, (1 - level) / rate)
+
+
+def _token(response):
+    return {
+        'access_token': response['access_token'],
+        'token_type': response['token_type'],
+        'expires_in': response['expires_in'],
+        'expires_at': datetime.utcnow() + timedelta(seconds=response['expires_in']),
+    }
+
+
+def _cache_key(url, params):
+    if not params:
+        return url
+    return url + '?' + urlencode(sorted(dict(params).items()))
@@ -0,0 +1,41 @@
+import os
+import sys
+from types import SimpleNamespace
+
+# Configs are read from paths relative to the repository root, as when running main.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+
+import mongomock
+import pytest
+
+from config import LogType
+
+
+class FakeBot:
+    """Stand-in for OsuBot with the Database cog connected to an in-memory MongoDB.
+    Bots sharing one database behave like separate processes sharing one server.
+    """
+    def __init__(self, db):
+        self.database = SimpleNamespace(db=db)
+        self.logs = []
+
+    def log(self, message, log_type=LogType.DEBUG):
+        self.logs.append((message, log_type))
+
+    def db(self):
+        return self.database
+
+    def errors(self):
+        return [message for message, log_type in self.logs if log_type is LogType.ERROR]
+
+
+@pytest.fixture
+def database():
+    return mongomock.MongoClient()['osu_bot']
+
+
+@pytest.fixture
+def make_bot(database):
+    return lambda: FakeBot(database)
@@ -0,0 +1,139 @@
+"""Local MongoDB stand-in server.
+
+Serves the commands SharedState uses over the MongoDB wire protocol, backed by an
+in-memory mongomock database, so several processes can share state without a
+mongod installed. Each command runs under one lock, making it atomic as on a
+real server.
+
+Requires `mockupdb` and `mongomock`. Run from the repository root:
+    python tests/mongo_standin.py [port]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mockupdb
+import mongomock
+from pymongo import errors, ReturnDocument
+
+import config
+
+DB_CONFIGS = config.get_cog_configs('database')
+
+
+class MongoStandin:
+    def __init__(self, port=int(DB_CONFIGS.host_port)):
+        self.client = mongomock.MongoClient()
+        self.lock = threading.Lock()
+        self.server = mockupdb.MockupDB(port=port, auto_ismaster=True,
+                                        min_wire_version=0, max_wire_version=21)
+        self.server.autoresponds(self.respond)
+
+    def run(self):
+        self.server.run()
+        return self.server.uri
+
+    def stop(self):
+        self.server.stop()
+
+    def respond(self, request):
+        name = request.command_name
+        if name.lower() in ('ismaster', 'hello'):
+            return False  # answered by mockupdb's own handshake responder
+        handler = getattr(self, '_' + name.lower(), None)
+        if handler is None:
+            request.ok()
+            return True
+
+        doc = request.doc
+        collection = self.client[doc['$db']][doc[name]] if isinstance(doc[name], str) else None
+        with self.lock:
+            try:
+                reply = handler(collection, doc, getattr(request, 'docs', ()))
+            except errors.DuplicateKeyError as error:
+                request.command_err(code=11000, errmsg=str(error))
+                return True
+        request.ok(**reply)
+        return True
+
+    @staticmethod
+    def _find(collection, doc, sections):
+        cursor = collection.find(doc.get('filter', {}))
+        if doc.get('limit'):
+            cursor = cursor.limit(abs(doc['limit']))
+        return {'cursor': {'id': 0, 'ns': collection.full_name, 'firstBatch': list(cursor)}}
+
+    @staticmethod
+    def _insert(collection, doc, sections):
+        documents = doc.get('documents') or [d for d in sections if d is not doc]
+        write_errors = []
+        for index, document in enumerate(documents):
+            try:
+                collection.insert_one(dict(document))
+            except errors.DuplicateKeyError as error:
+                write_errors.append({'index': index, 'code': 11000, 'errmsg': str(error)})
+        reply = {'n': len(documents) - len(write_errors)}
+        if write_errors:
+            reply['writeErrors'] = write_errors
+        return reply
+
+    @staticmethod
+    def _update(collection, doc, sections):
+        reply = {'n': 0, 'nModified': 0}
+        upserted = []
+        for index, update in enumerate(doc.get('updates') or [d for d in sections if d is not doc]):
+            method = collection.update_many if update.get('multi') else collection.update_one
+            if not any(key.startswith('$') for key in update['u']):
+                method = collection.replace_one
+            result = method(update['q'], update['u'], upsert=update.get('upsert', False))
+            reply['n'] += result.matched_count
+            reply['nModified'] += result.modified_count
+            if result.upserted_id is not None:
+                reply['n'] += 1
+                upserted.append({'index': index, '_id': result.upserted_id})
+        if upserted:
+            reply['upserted'] = upserted
+        return reply
+
+    @staticmethod
+    def _delete(collection, doc, sections):
+        n = 0
+        for delete in doc.get('deletes') or [d for d in sections if d is not doc]:
+            method = collection.delete_one if delete.get('limit') else collection.delete_many
+            n += method(delete['q']).deleted_count
+        return {'n': n}
+
+    @staticmethod
+    def _findandmodify(collection, doc, sections):
+        query = doc.get('query', {})
+        if doc.get('remove'):
+            value = collection.find_one_and_delete(query)
+        else:
+            value = collection.find_one_and_update(
+                query, doc['update'], upsert=doc.get('upsert', False),
+                return_document=ReturnDocument.AFTER if doc.get('new') else ReturnDocument.BEFORE)
+        return {'value': value, 'lastErrorObject': {'n': int(value is not None)}}
+
+    @staticmethod
+    def _createindexes(collection, doc, sections):
+        for index in doc['indexes']:
+            options = {key: value for key, value in index.items() if key not in ('key', 'v')}
+            collection.create_index(list(index['key'].items()), **options)
+        return {}
+
+    def _drop(self, collection, doc, sections):
+        collection.database.drop_collection(collection.name)
+        return {}
+
+
+if __name__ == '__main__':
+    standin = MongoStandin(*(int(arg) for arg in sys.argv[1:2]))
+    print(f"MongoDB stand-in listening on {standin.run()}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        standin.stop()
@@ -0,0 +1,148 @@
+"""Runs several processes sharing API state through a local MongoDB server.
+
+Each process stands in for a bot process with the shared state enabled: it asks
+for the API token, fetches one response through the shared cache and then takes
+requests from the shared rate limit as fast as it allows for a few seconds.
+Afterwards the script checks that the processes cooperated: one token refresh,
+one fetch and no more than `rate_limit` requests granted in any `rate_window`.
+
+Uses the MongoDB server at the host and port in cogs/database/configs.yml, or with
+--standin starts tests/mongo_standin.py there first. Run from the repository root:
+    python tests/shared_processes.py [processes] [--standin]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pymongo import MongoClient
+
+import config
+from config import LogType
+from cogs.api import shared
+from cogs.api.shared import SharedState
+
+DB_CONFIGS = config.get_cog_configs('database')
+PREFIX = 'shared_processes'
+DURATION = 6  # seconds each process keeps taking requests
+
+# Keep the run's state apart from a bot's own collections, and shrink the
+# rate limit to a 2 second window so a short run crosses several of them
+for name, value in {'collection_prefix': PREFIX, 'rate_limit': 20, 'rate_window': 2,
+                    'burst': 5, 'lease_size': 5, 'poll_interval': 0.05}.items():
+    setattr(shared.CONFIGS, name, value)
+
+
+class ProcessBot:
+    def __init__(self, db):
+        self.db_cog = type('Database', (), {'db': db})
+        self.errors = []
+
+    def log(self, message, log_type=LogType.DEBUG):
+        if log_type is LogType.ERROR:
+            self.errors.append(message)
+
+    def db(self):
+        return self.db_cog
+
+
+def connect():
+    server = "mongodb://" + DB_CONFIGS.host_name + ":" + DB_CONFIGS.host_port + "/"
+    return MongoClient(server)[DB_CONFIGS.database_name]
+
+
+async def work(db):
+    bot = ProcessBot(db)
+    state = SharedState(bot)
+
+    async def refresh():
+        db[PREFIX + '_calls'].insert_one({'call': 'refresh'})
+        await asyncio.sleep(0.2)
+        return {'access_token': 'shared', 'token_type': 'Bearer', 'expires_in': 86400}
+
+    async def request():
+        await state.acquire()
+        db[PREFIX + '_calls'].insert_one({'call': 'fetch'})
+        await asyncio.sleep(0.2)
+        return {'id': 2}, True
+
+    token = await state.token(refresh)
+    await state.fetch('https://osu.ppy.sh/api/v2/users/2/osu', None, request)
+
+    # Several concurrent callers per process, as with commands handled at once
+    granted = []
+    deadline = time.time() + DURATION
+
+    async def caller():
+        while time.time() < deadline:
+            await state.acquire()
+            granted.append(time.time())
+
+    await asyncio.gather(*(caller() for _ in range(3)))
+    return token['access_token'], granted, bot.errors
+
+
+def run(results):
+    results.put(asyncio.run(work(connect())))
+
+
+def busiest_window(moments, window):
+    moments = sorted(moments)
+    return max(sum(start <= moment < start + window for moment in moments) for start in moments)
+
+
+def main(processes):
+    db = connect()
+    for name in ('_state', '_cache', '_calls'):
+        db.drop_collection(PREFIX + name)
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run, args=(results,)) for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    calls = Counter(call['call'] for call in db[PREFIX + '_calls'].find())
+    tokens = {token for token, _, _ in outcomes}
+    granted = [moment for _, moments, _ in outcomes for moment in moments]
+    per_process = [len(moments) for _, moments, _ in outcomes]
+    errors = [error for _, _, process_errors in outcomes for error in process_errors]
+    busiest = busiest_window(granted, shared.CONFIGS.rate_window)
+    print(f"processes: {processes}, token refreshes: {calls['refresh']}, fetches: {calls['fetch']}")
+    span = max(granted) - min(granted)
+    print(f"requests granted: {len(granted)} over {span:.1f}s {per_process}, "
+          f"busiest {shared.CONFIGS.rate_window}s window: {busiest} "
+          f"(rate_limit {shared.CONFIGS.rate_limit}, burst {shared.CONFIGS.burst})")
+
+    assert not errors, errors
+    assert tokens == {'shared'}
+    assert calls['refresh'] == 1
+    assert calls['fetch'] == 1
+    assert busiest <= shared.CONFIGS.rate_limit
+    print("OK")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('processes', type=int, nargs='?', default=4)
+    parser.add_argument('--standin', action='store_true',
+                        help="serve MongoDB from tests/mongo_standin.py instead of a mongod")
+    args = parser.parse_args()
+
+    standin = None
+    if args.standin:
+        from mongo_standin import MongoStandin
+        standin = MongoStandin()
+        standin.run()
+    try:
+        main(args.processes)
+    finally:
+        if standin:
+            standin.stop()
@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from cogs.api.api import CONFIGS, OsuApi
+from cogs.api.shared import SharedState
+
+
+class FakeResponse:
+    status = 200
+
+    async def json(self):
+        return {'id': 2}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeSession:
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, params=None):
+        self.requests.append(url)
+        return FakeResponse()
+
+
+def shared_cog(bot, expires_at):
+    """Builds a cog already holding the shared token 'old', expiring at ``expires_at``."""
+    cog = OsuApi(bot)
+    cog.shared = SharedState(bot)
+    cog.token = 'old'
+    cog.token_type = 'Bearer'
+    cog.token_expires_at = expires_at
+    return cog
+
+
+def publish(database, access_token, expires_at):
+    database['api_state'].replace_one({'_id': 'token'}, {
+        'access_token': access_token,
+        'token_type': 'Bearer',
+        'expires_in': 86400,
+        'expires_at': expires_at,
+    }, upsert=True)
+
+
+def test_fetch_picks_up_token_published_by_another_process(make_bot, database):
+    expires_at = datetime.utcnow() + timedelta(seconds=CONFIGS.shared.token_margin - 1)
+    cog = shared_cog(make_bot(), expires_at)
+    publish(database, 'old', expires_at)
+
+    async def main():
+        cog._OsuApi__client = aiohttp.ClientSession(headers={'Authorization': 'Bearer old'})
+        try:
+            publish(database, 'new', datetime.utcnow() + timedelta(days=1))
+            session = FakeSession()
+            assert await cog.fetch('url', client=session) == {'id': 2}
+            return cog._OsuApi__client.headers['Authorization'], session.requests
+        finally:
+            await cog._OsuApi__client.close()
+
+    authorization, requests = asyncio.run(main())
+    assert cog.token == 'new'
+    assert authorization == 'Bearer new'
+    assert requests == ['url']
+
+
+def test_fetch_keeps_token_outside_margin(make_bot, database):
+    expires_at = datetime.utcnow() + timedelta(days=1)
+    cog = shared_cog(make_bot(), expires_at)
+    publish(database, 'new', expires_at)
+    asyncio.run(cog.fetch('url', client=FakeSession()))
+    assert cog.token == 'old'
+
+
+def test_fetch_refreshes_expiring_shared_token(make_bot, database):
+    expires_at = datetime.utcnow() + timedelta(seconds=CONFIGS.shared.token_margin - 1)
+    cog = shared_cog(make_bot(), expires_at)
+    publish(database, 'old', expires_at)
+    calls = []
+
+    async def request_token():
+        calls.append(None)
+        return {'access_token': 'fresh', 'token_type': 'Bearer', 'expires_in': 86400}
+
+    cog.request_token = request_token
+    asyncio.run(cog.fetch('url', client=FakeSession()))
+    assert len(calls) == 1
+    assert cog.token == 'fresh'
+    assert database['api_state'].find_one({'_id': 'token'})['access_token'] == 'fresh'
@@ -0,0 +1,287 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from pymongo import errors
+
+from cogs.api import shared
+from cogs.api.shared import SharedState, _cache_key
+
+# mongomock's TTL index expires documents by the real clock, so the fake one starts from it
+START = time.time()
+
+
+class Clock:
+    """Controls both clocks SharedState reads: time.time() for the rate limit bucket
+    and datetime.utcnow() for token, lock and cache expiry.
+    """
+    def __init__(self):
+        self.now = START
+
+    def time(self):
+        return self.now
+
+    def utcnow(self):
+        return datetime.utcfromtimestamp(self.now)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+
+    class FakeDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return clock.utcnow()
+
+    monkeypatch.setattr(shared, 'time', SimpleNamespace(time=clock.time))
+    monkeypatch.setattr(shared, 'datetime', FakeDatetime)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def configs(monkeypatch):
+    for name, value in {'rate_limit': 10, 'rate_window': 60, 'burst': 4, 'lease_size': 4,
+                        'fallback_rate_limit': 3, 'poll_interval': 0.01,
+                        'pending_timeout': 5, 'cache_ttl': 60}.items():
+        monkeypatch.setattr(shared.CONFIGS, name, value)
+
+
+class Broken:
+    """Collection whose every call fails as if the database server were unreachable."""
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise errors.ServerSelectionTimeoutError('no servers')
+        return fail
+
+
+def counting_refresh(calls):
+    async def refresh():
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        return {'access_token': f'token{len(calls)}', 'token_type': 'Bearer', 'expires_in': 86400}
+    return refresh
+
+
+async def take(states, attempts):
+    """Acquires up to ``attempts`` requests per state, returning how many were granted."""
+    granted = 0
+    for state in states:
+        for _ in range(attempts):
+            try:
+                await asyncio.wait_for(state.acquire(), 0.05)
+            except asyncio.TimeoutError:
+                break
+            granted += 1
+    return granted
+
+
+def test_concurrent_token_callers_refresh_once(make_bot, clock):
+    states = [SharedState(make_bot()) for _ in range(4)]
+    calls = []
+
+    async def main():
+        refresh = counting_refresh(calls)
+        return await asyncio.gather(*(state.token(refresh) for state in states for _ in range(3)))
+
+    tokens = asyncio.run(main())
+    assert len(calls) == 1
+    assert {token['access_token'] for token in tokens} == {'token1'}
+
+
+def test_token_published_before_lock_is_reused(make_bot, database, clock):
+    state = SharedState(make_bot())
+    published = {'_id': 'token', 'access_token': 'other', 'token_type': 'Bearer',
+                 'expires_in': 86400, 'expires_at': clock.utcnow() + timedelta(days=1)}
+    find_token = state._find_token
+    checks = []
+
+    async def racing_find_token():
+        # Another process publishes its token right after this one saw none
+        checks.append(None)
+        if len(checks) == 1:
+            database['api_state'].insert_one(published)
+            return None
+        return await find_token()
+
+    state._find_token = racing_find_token
+    calls = []
+    token = asyncio.run(state.token(counting_refresh(calls)))
+    assert calls == []
+    assert token['access_token'] == 'other'
+    assert database['api_state'].find_one({'_id': 'token_lock'}) is None
+
+
+def test_token_lock_released_when_recheck_fails(make_bot, database, clock):
+    state = SharedState(make_bot())
+    find_token = state._find_token
+    checks = []
+
+    async def failing_find_token():
+        # The database drops out right after the refresh lock is taken
+        checks.append(None)
+        if len(checks) == 1:
+            return await find_token()
+        raise errors.AutoReconnect('connection lost')
+
+    state._find_token = failing_find_token
+    calls = []
+    token = asyncio.run(state.token(counting_refresh(calls)))
+    assert len(calls) == 1
+    assert token['access_token'] == 'token1'
+    assert database['api_state'].find_one({'_id': 'token_lock'}) is None
+
+
+def test_token_refreshed_within_margin(make_bot, clock):
+    state = SharedState(make_bot())
+    calls = []
+    refresh = counting_refresh(calls)
+    asyncio.run(state.token(refresh))
+    clock.now += 86400 - shared.CONFIGS.token_margin + 1
+    token = asyncio.run(state.token(refresh))
+    assert len(calls) == 2
+    assert token['access_token'] == 'token2'
+
+
+def bucket(database):
+    return database['api_state'].find_one({'_id': 'bucket'})
+
+
+def test_processes_share_one_burst(make_bot, database, clock):
+    states = [SharedState(make_bot()) for _ in range(4)]
+    assert asyncio.run(take(states, 10)) == shared.CONFIGS.burst
+    assert bucket(database)['level'] == 0
+
+
+def test_idle_process_leases_one_request(make_bot, database, clock):
+    state = SharedState(make_bot())
+    assert asyncio.run(take([state], 1)) == 1
+    assert bucket(database)['level'] == shared.CONFIGS.burst - 1
+
+
+def test_no_rate_window_exceeds_rate_limit(make_bot, clock):
+    states = [SharedState(make_bot()) for _ in range(3)]
+    granted = []
+
+    async def main():
+        # Every process asks for more than the budget every second for five windows
+        for _ in range(5 * shared.CONFIGS.rate_window):
+            for state in states:
+                taken, _ = await state._take(shared.CONFIGS.lease_size)
+                granted.extend([clock.now] * taken)
+            clock.now += 1
+
+    asyncio.run(main())
+    window = shared.CONFIGS.rate_window
+    for start in granted:
+        assert sum(start <= moment < start + window for moment in granted) <= shared.CONFIGS.rate_limit
+    # Steady use runs at rate_limit - burst per window, after the initial burst
+    assert len(granted) == shared.CONFIGS.burst + 5 * (shared.CONFIGS.rate_limit - shared.CONFIGS.burst) - 1
+
+
+def test_concurrent_acquires_use_every_lease(make_bot, monkeypatch):
+    # Real clock: the bucket refills at 20 requests a second
+    monkeypatch.setattr(shared.CONFIGS, 'rate_window', 0.3)
+    state = SharedState(make_bot())
+    take = state._take
+    taken = []
+
+    async def counting_take(size):
+        granted, wait = await take(size)
+        taken.append(granted)
+        return granted, wait
+
+    state._take = counting_take
+
+    async def caller(delay):
+        await asyncio.sleep(delay)
+        await state.acquire()
+
+    async def main():
+        await asyncio.wait_for(asyncio.gather(*(caller(i * 0.01) for i in range(20))), 5)
+
+    asyncio.run(main())
+    assert sum(taken) == 20
+    assert state._granted == 0
+
+
+def test_budget_exhausted_fetch_still_fetches_once(make_bot, monkeypatch):
+    # Real clock: one request a second, and fetch locks lapse after 0.2 seconds unless renewed
+    for name, value in {'rate_limit': 2, 'burst': 1, 'rate_window': 1, 'pending_timeout': 0.2}.items():
+        monkeypatch.setattr(shared.CONFIGS, name, value)
+    states = [SharedState(make_bot()) for _ in range(3)]
+    calls = []
+
+    def limited_request(state):
+        async def request():
+            await state.acquire()
+            calls.append(None)
+            return {'calls': len(calls)}, True
+        return request
+
+    async def main():
+        await states[0].acquire()  # spend the burst
+        return await asyncio.gather(*(state.fetch('url', None, limited_request(state))
+                                      for state in states))
+
+    assert asyncio.run(main()) == [{'calls': 1}] * 3
+    assert len(calls) == 1
+
+
+def fetcher(calls, cacheable=True):
+    async def request():
+        calls.append(None)
+        await asyncio.sleep(0.05)
+        return {'calls': len(calls)}, cacheable
+    return request
+
+
+def test_cache_serves_until_ttl_expires(make_bot, clock):
+    state = SharedState(make_bot())
+    calls = []
+    request = fetcher(calls)
+    assert asyncio.run(state.fetch('url', {'limit': 5}, request)) == {'calls': 1}
+    assert asyncio.run(state.fetch('url', {'limit': 5}, request)) == {'calls': 1}
+    clock.now += shared.CONFIGS.cache_ttl + 1
+    assert asyncio.run(state.fetch('url', {'limit': 5}, request)) == {'calls': 2}
+
+
+def test_failed_responses_are_not_cached(make_bot, clock):
+    state = SharedState(make_bot())
+    calls = []
+    request = fetcher(calls, cacheable=False)
+    asyncio.run(state.fetch('url', None, request))
+    asyncio.run(state.fetch('url', None, request))
+    assert len(calls) == 2
+
+
+def test_concurrent_misses_fetch_once(make_bot, clock):
+    states = [SharedState(make_bot()) for _ in range(4)]
+    calls = []
+
+    async def main():
+        request = fetcher(calls)
+        return await asyncio.gather(*(state.fetch('url', None, request) for state in states))
+
+    assert asyncio.run(main()) == [{'calls': 1}] * 4
+    assert len(calls) == 1
+
+
+def test_cache_key_ignores_param_order():
+    assert _cache_key('url', {'limit': 5, 'offset': 10}) == _cache_key('url', {'offset': 10, 'limit': 5})
+    assert _cache_key('url', None) == 'url'
+
+
+def test_database_failure_falls_back_to_local_state(make_bot, clock):
+    bot = make_bot()
+    state = SharedState(bot)
+    state.state = state.cache = Broken()
+
+    calls = []
+    token = asyncio.run(state.token(counting_refresh(calls)))
+    assert token['access_token'] == 'token1'
+    assert asyncio.run(state.fetch('url', None, fetcher([]))) == {'calls': 1}
+    assert asyncio.run(take([state], 10)) == 1
+    assert bot.errors()